@@ -2,6 +2,8 @@
 #include <Python.h>
 #include <sys/syscall.h>
 #include <sys/mount.h>
+#include <sys/stat.h>
+#include <errno.h>
 #include <sched.h>
 #include <sys/wait.h>
 #include <unistd.h>
@@ -80,6 +82,60 @@ static PyObject * _mount(PyObject *self, PyObject *args) {
     }
 }
 
+#define MOUNT_ALL_DOC   ".. py:function:: mount_all(mounts)\n"\
+                        "\n"\
+                        "mount several filesystems with a single call, creating each target directory\n"\
+                        "if it does not exist yet\n"\
+                        "\n"\
+                        ":param mounts: sequence of ``(source, target, filesystemtype, mountflags, mountopts)``\n"\
+                        "               tuples, taking the same values as the arguments of :py:func:`mount`.\n"\
+                        "               Filesystems are mounted in order, so a target may be inside a\n"\
+                        "               filesystem mounted by a previous entry.\n"\
+                        ":return: None\n"\
+                        ":raises RuntimeError: if creating a target directory or mount fails. Filesystems\n"\
+                        "                      mounted before the failing entry stay mounted.\n"\
+                        "\n"
+
+static PyObject * _mount_all(PyObject *self, PyObject *args) {
+    PyObject *mounts, *seq, *item;
+    const char *source, *target, *filesystemtype, *mountopts;
+    unsigned long mountflags;
+    Py_ssize_t i;
+
+    if (!PyArg_ParseTuple(args, "O", &mounts)) {
+        return NULL;
+    }
+
+    if ((seq = PySequence_Fast(mounts, "mounts must be a sequence")) == NULL) {
+        return NULL;
+    }
+
+    for (i = 0; i < PySequence_Fast_GET_SIZE(seq); i++) {
+        item = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PyTuple_Check(item)) {
+            PyErr_SetString(PyExc_TypeError, "each mount must be a tuple");
+            Py_DECREF(seq);
+            return NULL;
+        }
+
+        if (!PyArg_ParseTuple(item, "zszkz", &source, &target, &filesystemtype, &mountflags, &mountopts)) {
+            Py_DECREF(seq);
+            return NULL;
+        }
+
+        if ((mkdir(target, 0755) == -1 && errno != EEXIST) ||
+                mount(source, target, filesystemtype, mountflags, mountopts) == -1) {
+            PyErr_SetFromErrnoWithFilename(PyExc_RuntimeError, target);
+            Py_DECREF(seq);
+            return NULL;
+        }
+    }
+
+    Py_DECREF(seq);
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
 #define UMOUNT_DOC  ".. py:function:: umount(target)\n"\
                     "\n"\
                     "unmount filesystem\n"\
@@ -289,6 +345,7 @@ static PyMethodDef linux_methods[] = {
     {"clone", _clone, METH_VARARGS, CLONE_DOC},
     {"sethostname", _sethostname, METH_VARARGS, SETHOSTNAME_DOC},
     {"mount", _mount, METH_VARARGS, MOUNT_DOC},
+    {"mount_all", _mount_all, METH_VARARGS, MOUNT_ALL_DOC},
     {"umount", _umount, METH_VARARGS, UMOUNT_DOC},
     {"umount2", _umount2, METH_VARARGS, UMOUNT2_DOC},
     {NULL, NULL, 0, NULL}        /* Sentinel */
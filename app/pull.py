@@ -1,16 +1,84 @@
-import json
+import hashlib
+import itertools
+import logging
+import multiprocessing
 import os
+import queue
 import re
+import shutil
+import stat
 import sys
 import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Iterable
+from logging.handlers import QueueHandler, QueueListener
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# イメージ名 ([library/]image[:tag]) をパースする正規表現
+_IMAGE_RE = re.compile(r'((?P<library>[^/:]*)/)?(?P<image>[^/:]+)(:)?(?P<tag>[^/:]*)')
+
+
+@contextmanager
+def _open_for_atomic_write(path: str, digest: str) -> Iterator[Tuple[BinaryIO, 'hashlib._Hash']]:
+    """
+    同じディレクトリの一時ファイルに書き込み、書き込みが完了したらリネームする
+    途中で失敗した場合や中断された場合に、書きかけのファイルが path に残らないようにする
+    書き込んだデータのハッシュ値が digest と一致しない場合は IOError を送出し、path には保存しない
+    :param path: 保存先のファイルパス
+    :param digest: <アルゴリズム>:<16進数> 形式の digest
+    :return: 書き込み先のファイルと、書き込んだデータで更新するハッシュオブジェクト
+    """
+    algorithm, _, expected = digest.partition(':')
+    hasher = hashlib.new(algorithm)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.',
+                                     suffix='.tmp', delete=False) as f:
+        try:
+            yield f, hasher
+            # 壊れたデータがキャッシュとして使い回されないよう、保存する前に digest を検証する
+            if hasher.hexdigest() != expected:
+                raise IOError(f'Digest mismatch for {path}: expected {digest}, got {algorithm}:{hasher.hexdigest()}')
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.rename(f.name, path)
+
+
+class _TeeReader:
+    """
+    読み込んだデータを別のファイルにも書き込み、ハッシュ値を計算するファイルオブジェクト
+    レスポンスを展開しながら、同じデータをキャッシュに保存するために使う
+    """
+
+    def __init__(self, source: BinaryIO, sink: BinaryIO, hasher: 'hashlib._Hash'):
+        self.source = source
+        self.sink = sink
+        self.hasher = hasher
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.source.read(size)
+        self.sink.write(data)
+        self.hasher.update(data)
+        return data
 
 
 class DockerRegistoryClient:
     REGISTRY_ENDPOINT = 'https://registry-1.docker.io/v2'
+    # 有効期限までの残り時間がこの秒数を切った認証トークンは取得し直す
+    AUTH_TOKEN_EXPIRY_MARGIN_SECONDS = 30
+    # レイヤーをダウンロードする際に一度に読み込むバイト数
+    DOWNLOAD_CHUNK_SIZE = 1 << 20
 
     @dataclass(frozen=True)
     class RegistoryAuthTokenResponse:
@@ -21,10 +89,17 @@ class DockerRegistoryClient:
         def token(self) -> str:
             return self.content['token']
 
+        @property
+        def expires_in(self) -> int:
+            # 有効期限が返されない場合は 60 秒とみなす
+            return self.content.get('expires_in', 60)
+
     @dataclass(frozen=True)
     class ImageManifestResponse:
         # https://docs.docker.com/registry/spec/manifest-v2-1/
         content: dict
+        # レジストリから返されたままのマニフェスト
+        raw: bytes
 
         @property
         def name(self) -> str:
@@ -38,19 +113,93 @@ class DockerRegistoryClient:
         def layer_digests(self) -> list:
             return [layer['blobSum'] for layer in self.content['fsLayers']]
 
+    def __init__(self, max_connections: int = 10):
+        """
+        :param max_connections: ホストごとに保持するコネクションの最大数
+        """
+        # 同じホストへのリクエストで TCP/TLS のコネクションを使い回す
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=max_connections,
+            pool_maxsize=max_connections,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        ))
+
+        # (library, image) ごとの認証トークンとその有効期限
+        self._auth_token_cache: Dict[Tuple[str, str],
+                                     Tuple[DockerRegistoryClient.RegistoryAuthTokenResponse, float]] = {}
+        self._auth_token_cache_lock = threading.Lock()
+
     def get_image_pull_auth_token(self, library: str, image: str) -> RegistoryAuthTokenResponse:
         """
         認証トークンを取得する
+        有効期限内のトークンがあればそれを使い回す
+        :param library:
+        :param image:
+        :return:
+        """
+        # レイヤーを並列にダウンロードする際に同時にトークンを取得しないようにロックする
+        with self._auth_token_cache_lock:
+            cached = self._auth_token_cache.get((library, image))
+            if cached and time.monotonic() < cached[1]:
+                return cached[0]
+
+            auth_token = self._fetch_image_pull_auth_token(library, image)
+            expires_at = time.monotonic() + auth_token.expires_in - self.AUTH_TOKEN_EXPIRY_MARGIN_SECONDS
+            self._auth_token_cache[(library, image)] = (auth_token, expires_at)
+            return auth_token
+
+    def _fetch_image_pull_auth_token(self, library: str, image: str) -> RegistoryAuthTokenResponse:
+        """
+        認証トークンを認証サーバーから取得する
         :param library:
         :param image:
         :return:
         """
         url = f'https://auth.docker.io/token?service=registry.docker.io&scope=repository:{library}/{image}:pull'
-        print(f'Get authtoken, url: {url}')
-        response = requests.get(url)
+        logger.info('Get authtoken, url: %s', url)
+        # 認証サーバーにはレジストリ用のトークンを送らない
+        response = self.session.get(url, headers={'Authorization': None})
         response.raise_for_status()
         return self.RegistoryAuthTokenResponse(content=response.json())
 
+    def authorize(self, library: str, image: str, rejected_authorization: Optional[str] = None):
+        """
+        認証トークンを取得し、以降のリクエストに Authorization ヘッダーとして付与する
+        有効期限内のトークンがキャッシュにあれば、認証サーバーには問い合わせない
+        :param library:
+        :param image:
+        :param rejected_authorization: レジストリに拒否された Authorization ヘッダー
+                                       キャッシュしたトークンがこれと同じ場合は取得し直す
+        :return:
+        """
+        if rejected_authorization is not None:
+            with self._auth_token_cache_lock:
+                cached = self._auth_token_cache.get((library, image))
+                # 並列にダウンロードしている別のスレッドが取得し直したトークンは捨てずに使う
+                if cached and rejected_authorization == f'Bearer {cached[0].token}':
+                    del self._auth_token_cache[(library, image)]
+        self.session.headers['Authorization'] = f'Bearer {self.get_image_pull_auth_token(library, image).token}'
+
+    def _request(self, method: str, url: str, library: str, image: str, **kwargs) -> requests.Response:
+        """
+        レジストリにリクエストを送る
+        トークンの有効期限が近い場合は送る前に取得し直し、それでも拒否された場合は認証し直してからもう一度送る
+        :param method:
+        :param url:
+        :param library:
+        :param image:
+        :param kwargs: requests に渡す引数
+        :return:
+        """
+        self.authorize(library, image)
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code == 401:
+            response.close()
+            self.authorize(library, image, rejected_authorization=response.request.headers.get('Authorization'))
+            response = self.session.request(method, url, **kwargs)
+        return response
+
     def get_manifest(self, library: str, image: str, tag: str) -> ImageManifestResponse:
         """
         マニフェストを取得する
@@ -61,14 +210,25 @@ class DockerRegistoryClient:
         """
         # 各レイヤーをダウンロードする
         url = f'{self.REGISTRY_ENDPOINT}/{library}/{image}/manifests/{tag}'
-        print(f'Downloading manifest, url: {url}')
-        response = requests.get(
-            url,
-            headers={
-                'Authorization': f'Bearer {self.get_image_pull_auth_token(library, image).token}'
-            })
+        logger.info('Downloading manifest, url: %s', url)
+        response = self._request('GET', url, library, image)
         response.raise_for_status()
-        return self.ImageManifestResponse(content=response.json())
+        return self.ImageManifestResponse(content=response.json(), raw=response.content)
+
+    def open_layer(self, library: str, image: str, layer_digest: str) -> requests.Response:
+        """
+        Docker イメージのレイヤーのダウンロードを開始する
+        レスポンスのボディは読み込まずに返すので、呼び出し側でストリームとして読み込む
+        :param library:
+        :param image:
+        :param layer_digest:
+        :return:
+        """
+        logger.info('Fetching layer %s ..', layer_digest)
+        response = self._request('GET', f'{self.REGISTRY_ENDPOINT}/{library}/{image}/blobs/{layer_digest}',
+                                 library, image, stream=True)
+        response.raise_for_status()
+        return response
 
     def download_layer(self, library: str, image: str, layer_digest: str) -> Iterable[bytes]:
         """
@@ -78,81 +238,475 @@ class DockerRegistoryClient:
         :param layer_digest:
         :return:
         """
-        # 各レイヤーをダウンロードする
-        print(f'Fetching layer {layer_digest} ..')
         # レイヤーのファイルをダウンロードする
-        response = requests.get(
-            f'{self.REGISTRY_ENDPOINT}/{library}/{image}/blobs/{layer_digest}',
-            stream=True,
-            headers={
-                'Authorization': f'Bearer {self.get_image_pull_auth_token(library, image).token}'
-            },
-        )
+        with self.open_layer(library, image, layer_digest) as response:
+            for chunk in response.iter_content(chunk_size=self.DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    yield chunk
+
+    def download_layer_ranges(self, library: str, image: str, layer_digest: str, path: str, n_parts: int):
+        """
+        Docker イメージのレイヤーを Range リクエストで分割して並列にダウンロードし、ファイルに保存する
+        サーバーが Range リクエストに対応していない場合は 1 つのストリームでダウンロードする
+        :param library:
+        :param image:
+        :param layer_digest:
+        :param path: 保存先のファイルパス
+        :param n_parts: 分割数
+        :return:
+        """
+        url = f'{self.REGISTRY_ENDPOINT}/{library}/{image}/blobs/{layer_digest}'
+        logger.info('Fetching layer %s in %s parts ..', layer_digest, n_parts)
+        # レイヤーのサイズを取得する
+        response = self._request('HEAD', url, library, image, allow_redirects=True)
         response.raise_for_status()
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                yield chunk
+        size = int(response.headers.get('Content-Length', 0))
+        if size <= 0:
+            # サイズが分からない場合は分割できないので 1 つのストリームでダウンロードする
+            logger.info('Layer size is unknown, fetching layer %s as a single stream ..', layer_digest)
+            self.download_layer_to_file(library, image, layer_digest, path)
+            return
+
+        # 保存先のファイルをあらかじめ確保し、各パートを自分のオフセットに書き込む
+        ranges = [(i * size // n_parts, (i + 1) * size // n_parts - 1) for i in range(n_parts)]
+        with _open_for_atomic_write(path, layer_digest) as (f, hasher):
+            os.ftruncate(f.fileno(), size)
+            with ThreadPoolExecutor(max_workers=n_parts) as executor:
+                futures = [
+                    executor.submit(self._download_range, url, library, image, f.fileno(), start, end)
+                    for start, end in ranges if start <= end
+                ]
+                ranges_supported = all(future.result() for future in futures)
+
+            if not ranges_supported:
+                logger.info('Range requests are not supported, fetching layer %s as a single stream ..', layer_digest)
+                f.truncate(0)
+                self._write_layer(library, image, layer_digest, f, hasher)
+            else:
+                # 各パートは別々のオフセットに書き込まれたので、保存したファイルを読み直してハッシュ値を計算する
+                f.seek(0)
+                for chunk in iter(lambda: f.read(self.DOWNLOAD_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+
+    def download_layer_to_file(self, library: str, image: str, layer_digest: str, path: str):
+        """
+        Docker イメージのレイヤーをダウンロードし、ファイルに保存する
+        :param library:
+        :param image:
+        :param layer_digest:
+        :param path: 保存先のファイルパス
+        :return:
+        """
+        with _open_for_atomic_write(path, layer_digest) as (f, hasher):
+            self._write_layer(library, image, layer_digest, f, hasher)
+
+    def _write_layer(self, library: str, image: str, layer_digest: str, f: BinaryIO, hasher: 'hashlib._Hash'):
+        """
+        Docker イメージのレイヤーをダウンロードし、チャンクごとにファイルに書き込む
+        メモリには 1 チャンク分しか保持しない
+        :param library:
+        :param image:
+        :param layer_digest:
+        :param f: 書き込み先のファイル
+        :param hasher: 書き込んだデータで更新するハッシュオブジェクト
+        :return:
+        """
+        with self.open_layer(library, image, layer_digest) as response:
+            response.raw.decode_content = True
+            for chunk in iter(lambda: response.raw.read(self.DOWNLOAD_CHUNK_SIZE), b''):
+                f.write(chunk)
+                hasher.update(chunk)
+
+    def _download_range(self, url: str, library: str, image: str, fd: int, start: int, end: int) -> bool:
+        """
+        レイヤーの一部を Range リクエストでダウンロードし、ファイルの該当するオフセットに書き込む
+        :param url:
+        :param library:
+        :param image:
+        :param fd: 書き込み先のファイルディスクリプタ
+        :param start: 開始位置のバイトオフセット
+        :param end: 終了位置のバイトオフセット (このバイトを含む)
+        :return: サーバーが Range リクエストに対応していない場合は False
+        """
+        response = self._request('GET', url, library, image, stream=True, headers={'Range': f'bytes={start}-{end}'})
+        with response:
+            response.raise_for_status()
+            # 206 Partial Content 以外はファイル全体が返ってきているので書き込まない
+            if response.status_code != 206:
+                return False
+            offset = start
+            for chunk in response.iter_content(chunk_size=self.DOWNLOAD_CHUNK_SIZE):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+
+        # 途中で切れたレスポンスを受け取った場合は、残りが 0 のまま保存されないようにエラーにする
+        if offset != end + 1:
+            raise IOError(f'Incomplete range response for {url}: '
+                          f'expected bytes {start}-{end}, got up to {offset - 1}')
+        return True
 
 
 class PullCommand:
     IMAGE_DATA_DIR = '/var/opt/app/images'
+    # ダウンロードしたレイヤーの tar を digest ごとに保存するディレクトリ
+    LAYER_CACHE_DIR = '/var/opt/app/layer_cache'
+    # 同時にダウンロードするレイヤーの最大数 (dockerd の max-concurrent-downloads と同じ)
+    DEFAULT_MAX_CONCURRENT_DOWNLOADS = 3
+    # 1 つのレイヤーを Range リクエストで分割してダウンロードする数 (1 の場合は分割しない)
+    DEFAULT_LAYER_DOWNLOAD_PARTS = 1
+    # レイヤーの tar を展開する際に一度に読み込むバイト数
+    EXTRACT_BUFFER_SIZE = 1 << 20
+    # レイヤーの tar に含まれる AUFS 形式のホワイトアウトファイルの名前
+    # https://github.com/opencontainers/image-spec/blob/master/layer.md#whiteouts
+    WHITEOUT_PREFIX = '.wh.'
+    WHITEOUT_OPAQUE = '.wh..wh..opq'
+    AUFS_METADATA_PREFIX = '.wh..wh.'
+    # コンテナの起動時に必要なディレクトリをあらかじめ作成しておくレイヤーのディレクトリ名
+    INIT_LAYER_DIR = 'init'
 
     @classmethod
-    def execute(cls, library: str, image: str, tag: str):
+    def execute(cls, library: str, image: str, tag: str,
+                max_concurrent_downloads: int = DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+                layer_download_parts: int = DEFAULT_LAYER_DOWNLOAD_PARTS,
+                verbose: bool = False, log_queue: Optional[queue.Queue] = None):
         """
         docker pull コマンド
+        :param library:
+        :param image:
+        :param tag:
+        :param max_concurrent_downloads: 同時にダウンロードするレイヤーの最大数
+        :param layer_download_parts: 1 つのレイヤーを分割してダウンロードする数
+        :param verbose: 展開したファイルを一部表示する
+        :param log_queue: 展開用の子プロセスからログを送るキュー
         :return:
         """
-        # ファイルを保存する ディレクトリ
-        base_dir = os.path.dirname('/var/opt/app/')
-        images_dir = os.path.join(base_dir, 'images')
-        if not os.path.exists(images_dir):
-            os.makedirs(images_dir)
-
         # マニフェストを取得する
-        client = DockerRegistoryClient()
+        # 同時に発行するリクエストの数だけコネクションを保持し、すべてのリクエストでコネクションを使い回す
+        client = DockerRegistoryClient(max_connections=max_concurrent_downloads * layer_download_parts)
+        # 認証は最初に 1 度だけ行い、以降のリクエストでは同じトークンを使う
+        client.authorize(library, image)
         manifest = client.get_manifest(library, image, tag)
 
         image_name_friendly = f"{manifest.name.replace('/', '_')}_{manifest.tag}"
-        image_base_dir = os.path.join(images_dir, image_name_friendly)
-
-        # マニフェストの json を保存する
-        with open(os.path.join(images_dir,
-                               image_name_friendly + '.json'), 'w') as manifest_file:
-            manifest_file.write(json.dumps(manifest.content, ensure_ascii=False, indent=2, sort_keys=True, separators=(',', ': ')))
+        image_base_dir = os.path.join(cls.IMAGE_DATA_DIR, image_name_friendly)
 
         # docker イメージのレイヤーを保存するディレクトリを作成する
+        # 途中のディレクトリもまとめて作成される
         # hoge/image_name/layers/contents
         image_layers_path = os.path.join(image_base_dir, 'layers')
         contents_path = os.path.join(image_layers_path, 'contents')
-        if not os.path.exists(contents_path):
-            os.makedirs(contents_path)
+        os.makedirs(contents_path, exist_ok=True)
 
-        # 各レイヤーをダウンロードする
-        for digest in manifest.layer_digests:
-            print('Fetching layer %s..' % digest)
-            # ダウンロードしたレイヤーを tar として保存する
-            local_layer_tar_name = os.path.join(image_layers_path, digest) + '.tar'
-            with open(local_layer_tar_name, 'wb') as f:
-                for chunk in client.download_layer(library, image, digest):
-                    if chunk:
-                        f.write(chunk)
-
-            # tar を展開する
-            with tarfile.open(local_layer_tar_name, 'r') as tar:
-                # tar ファイルの中身を一部表示する
-                for member in tar.getmembers()[:10]:
-                    print('- ' + member.name)
-                print('...')
-                tar.extractall(str(contents_path))
-                print('extract done')
-
-        print(f'Save docker image to {image_base_dir}')
-
-
-def main(image_name: str):
+        # マニフェストの json を保存する
+        # 署名と一致するよう、エンコードし直さずにレジストリから返されたまま保存する
+        with open(os.path.join(cls.IMAGE_DATA_DIR,
+                               image_name_friendly + '.json'), 'wb') as manifest_file:
+            manifest_file.write(manifest.raw)
+
+        # 同じレイヤーが複数回含まれることがあるので重複を除き、展開済みのレイヤーはダウンロードも展開もしない
+        layer_digests = [
+            digest for digest in dict.fromkeys(manifest.layer_digests)
+            if not cls._is_layer_extracted(cls._get_layer_contents_path(contents_path, digest))
+        ]
+
+        # レイヤーの tar は digest ごとにキャッシュし、同じレイヤーを含むイメージの間で共有する
+        os.makedirs(cls.LAYER_CACHE_DIR, exist_ok=True)
+
+        # 各レイヤーは layers/contents/<digest> に個別に展開し、コンテナの起動時にオーバーレイ FS で重ねる
+        if max_concurrent_downloads == 1 and layer_download_parts == 1:
+            # 並列にダウンロードしない場合は、レスポンスをキャッシュに保存しながら直接展開する
+            for digest in layer_digests:
+                layer_contents_path = cls._get_layer_contents_path(contents_path, digest)
+                cache_path = cls._get_layer_cache_path(digest)
+                if os.path.exists(cache_path):
+                    logger.info('Using cached layer %s', digest)
+                    cls._extract_layer_tar(cache_path, layer_contents_path, verbose)
+                else:
+                    try:
+                        with client.open_layer(library, image, digest) as response, \
+                                _open_for_atomic_write(cache_path, digest) as (cache_file, hasher):
+                            response.raw.decode_content = True
+                            tee = _TeeReader(response.raw, cache_file, hasher)
+                            cls._extract_layer(tee, layer_contents_path, verbose)
+                            # tar の終端より後ろに残っているデータも読み切ってキャッシュに保存する
+                            while tee.read(client.DOWNLOAD_CHUNK_SIZE):
+                                pass
+                    except BaseException:
+                        # digest の検証前に展開しているので、失敗した場合は展開済みのファイルも削除する
+                        shutil.rmtree(layer_contents_path, ignore_errors=True)
+                        try:
+                            os.remove(layer_contents_path + '.extracted')
+                        except FileNotFoundError:
+                            pass
+                        raise
+                cls._link_layer_tar(cache_path, image_layers_path, digest)
+        else:
+            # 各レイヤーを並列にダウンロードする
+            with ThreadPoolExecutor(max_workers=max_concurrent_downloads) as executor:
+                futures = [
+                    executor.submit(cls._download_to_tar, client, library, image, digest, image_layers_path,
+                                    layer_download_parts)
+                    for digest in layer_digests
+                ]
+                for future in as_completed(futures):
+                    # ダウンロードに失敗したレイヤーがあれば例外を送出する
+                    future.result()
+
+            # レイヤーごとに別のディレクトリに展開するので、GIL の影響を受けないよう別プロセスで並列に展開する
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(
+                    _extract_layer_tar_in_worker,
+                    itertools.repeat(log_queue),
+                    [os.path.join(image_layers_path, digest) + '.tar' for digest in layer_digests],
+                    [cls._get_layer_contents_path(contents_path, digest) for digest in layer_digests],
+                    itertools.repeat(verbose),
+                ))
+
+        # pivot_root で元のルートディレクトリを移す old_root をイメージの一番上のレイヤーとして作成しておき、
+        # コンテナの起動時にオーバーレイ FS の書き込み用のディレクトリに作成しなくて済むようにする
+        os.makedirs(os.path.join(contents_path, cls.INIT_LAYER_DIR, 'old_root'), exist_ok=True)
+
+        logger.info('Save docker image to %s', image_base_dir)
+
+    @classmethod
+    def _download_to_tar(cls, client: DockerRegistoryClient, library: str, image: str, digest: str,
+                         image_layers_path: str, layer_download_parts: int):
+        """
+        レイヤーをダウンロードして tar として保存する
+        キャッシュ済みのレイヤーはダウンロードしない
+        :param client:
+        :param library:
+        :param image:
+        :param digest:
+        :param image_layers_path:
+        :param layer_download_parts:
+        :return:
+        """
+        cache_path = cls._get_layer_cache_path(digest)
+        if os.path.exists(cache_path):
+            logger.info('Using cached layer %s', digest)
+        elif layer_download_parts > 1:
+            client.download_layer_ranges(library, image, digest, cache_path, layer_download_parts)
+        else:
+            client.download_layer_to_file(library, image, digest, cache_path)
+
+        cls._link_layer_tar(cache_path, image_layers_path, digest)
+
+    @classmethod
+    def _get_layer_cache_path(cls, digest: str) -> str:
+        """
+        キャッシュしたレイヤーの tar のパスを取得する
+        :param digest:
+        :return:
+        """
+        return os.path.join(cls.LAYER_CACHE_DIR, digest) + '.tar'
+
+    @staticmethod
+    def _link_layer_tar(cache_path: str, image_layers_path: str, digest: str):
+        """
+        キャッシュしたレイヤーの tar をイメージのディレクトリにハードリンクする
+        :param cache_path:
+        :param image_layers_path:
+        :param digest:
+        :return:
+        """
+        local_layer_tar_name = os.path.join(image_layers_path, digest) + '.tar'
+        if not os.path.exists(local_layer_tar_name):
+            os.link(cache_path, local_layer_tar_name)
+
+    @staticmethod
+    def _get_layer_contents_path(contents_path: str, digest: str) -> str:
+        """
+        レイヤーを展開するディレクトリのパスを取得する
+        オーバーレイ FS の lowerdir の区切り文字と重ならないよう digest のアルゴリズム部分は除く
+        :param contents_path:
+        :param digest: sha256:<16進数> 形式の digest
+        :return:
+        """
+        return os.path.join(contents_path, digest.split(':', 1)[-1])
+
+    @staticmethod
+    def _is_layer_extracted(layer_contents_path: str) -> bool:
+        """
+        レイヤーが展開済みかどうか
+        空のレイヤーのディレクトリが作成されていなかった以前の pull に備え、ディレクトリの存在も確認する
+        :param layer_contents_path:
+        :return:
+        """
+        return os.path.exists(layer_contents_path + '.extracted') and os.path.isdir(layer_contents_path)
+
+    @classmethod
+    def _extract_layer_tar(cls, tar_path: str, contents_path: str, verbose: bool):
+        """
+        保存したレイヤーの tar を展開する
+        :param tar_path:
+        :param contents_path:
+        :param verbose:
+        :return:
+        """
+        with open(tar_path, 'rb') as f:
+            cls._extract_layer(f, contents_path, verbose)
+
+    @classmethod
+    def _extract_layer(cls, fileobj: BinaryIO, contents_path: str, verbose: bool):
+        """
+        レイヤーの tar を先頭から順に読み込みながら展開する
+        シークしないので HTTP レスポンスのストリームもそのまま渡せる
+        :param fileobj:
+        :param contents_path:
+        :param verbose: tar ファイルの中身を一部表示する
+        :return:
+        """
+        # 空のレイヤーでもオーバーレイ FS の lowerdir に指定できるよう、ディレクトリは必ず作成する
+        os.makedirs(contents_path, exist_ok=True)
+        # ストリームモードの tarfile はデフォルトでは 10 KiB ずつしか読み込まないので、まとめて読み込む
+        with tarfile.open(fileobj=fileobj, mode='r|*', bufsize=cls.EXTRACT_BUFFER_SIZE) as tar:
+            members = cls._print_members(tar) if verbose else tar
+            tar.extractall(contents_path, members=cls._convert_whiteouts(members, contents_path))
+            logger.info('extract done')
+
+        # 展開済みの印をつけ、次に pull した際は展開しないようにする
+        open(contents_path + '.extracted', 'w').close()
+
+    @staticmethod
+    def _print_members(tar: tarfile.TarFile, limit: int = 10) -> Iterator[tarfile.TarInfo]:
+        """
+        tar ファイルの中身を展開しながら一部表示する
+        :param tar:
+        :param limit: 表示するファイルの数
+        :return:
+        """
+        for i, member in enumerate(tar):
+            if i < limit:
+                logger.info('- %s', member.name)
+            elif i == limit:
+                logger.info('...')
+            yield member
+
+    @classmethod
+    def _convert_whiteouts(cls, members: Iterable[tarfile.TarInfo],
+                           contents_path: str) -> Iterator[tarfile.TarInfo]:
+        """
+        AUFS 形式のホワイトアウトファイルを、オーバーレイ FS のホワイトアウトに変換する
+        レイヤーを別々のディレクトリに展開してオーバーレイ FS で重ねるので、
+        下のレイヤーのファイルを削除したことはオーバーレイ FS の形式で表す必要がある
+        ホワイトアウトファイル自体は展開しない
+        AUFS のメタデータ (.wh..wh.aufs や .wh..wh.plnk/ など) は展開せずに読み飛ばす
+        :param members:
+        :param contents_path:
+        :return:
+        """
+        root = os.path.realpath(contents_path)
+        for member in members:
+            dirname, basename = os.path.split(member.name)
+            # 展開先のディレクトリの外に書き込むようなパスは受け付けない
+            # 先に展開したシンボリックリンクをたどって外に出ないよう、実際のパスで確認する
+            # シンボリックリンク自体は置き換えられるだけなので、親ディレクトリだけを確認する
+            target = os.path.join(root, dirname if member.issym() else member.name)
+            if os.path.isabs(member.name) or '..' in member.name.split('/') \
+                    or not cls._is_within(root, target):
+                raise IOError(f'Unsafe path in layer: {member.name}')
+            # ハードリンクのリンク先は展開先のディレクトリからの相対パスなので、同様に外を指していないか確認する
+            if member.islnk() and not cls._is_within(root, os.path.join(root, member.linkname)):
+                raise IOError(f'Unsafe link in layer: {member.name} -> {member.linkname}')
+
+            if any(name.startswith(cls.AUFS_METADATA_PREFIX) for name in member.name.split('/')) \
+                    and basename != cls.WHITEOUT_OPAQUE:
+                continue
+            if not basename.startswith(cls.WHITEOUT_PREFIX):
+                yield member
+                continue
+
+            dir_path = os.path.join(root, dirname)
+            os.makedirs(dir_path, exist_ok=True)
+            if basename == cls.WHITEOUT_OPAQUE:
+                # ディレクトリを不透明にして、下のレイヤーのディレクトリの中身を隠す
+                os.setxattr(dir_path, 'trusted.overlay.opaque', b'y')
+            else:
+                # デバイス番号 0/0 のキャラクタデバイスを作成して、下のレイヤーのファイルを隠す
+                try:
+                    os.mknod(os.path.join(dir_path, basename[len(cls.WHITEOUT_PREFIX):]),
+                             stat.S_IFCHR, os.makedev(0, 0))
+                except FileExistsError:
+                    pass
+
+    @staticmethod
+    def _is_within(root: str, path: str) -> bool:
+        """
+        シンボリックリンクを解決した path が root の中にあるかどうか
+        :param root: シンボリックリンクを解決済みのディレクトリのパス
+        :param path:
+        :return:
+        """
+        return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+
+def _start_logging(log_queue: queue.Queue) -> Tuple[QueueListener, QueueHandler]:
+    """
+    ログをキューに送り、別スレッドからまとめて標準エラー出力に書き込むように設定する
+    レイヤーを並列にダウンロード・展開するスレッドやプロセスが、ログの出力を待たないようにする
+    :param log_queue: ログを送るキュー
+    :return: ログを書き込むスレッドと、ルートロガーに追加したハンドラ
+    """
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, stream_handler)
+
+    queue_handler = QueueHandler(log_queue)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(logging.INFO)
+    listener.start()
+    return listener, queue_handler
+
+
+# 展開用の子プロセスでログの設定が済んでいるかどうか
+_worker_logging_configured = False
+
+
+def _extract_layer_tar_in_worker(log_queue: Optional[queue.Queue], tar_path: str, contents_path: str,
+                                 verbose: bool):
+    """
+    展開用の子プロセスで、ログを親プロセスのキューに送るように設定してからレイヤーの tar を展開する
+    spawn や forkserver で起動した子プロセスには親プロセスのログの設定が引き継がれないので、キューを引数で受け取る
+    :param log_queue: 親プロセスのログのキュー
+    :param tar_path:
+    :param contents_path:
+    :param verbose:
+    :return:
+    """
+    global _worker_logging_configured
+    if log_queue is not None and not _worker_logging_configured:
+        root_logger = logging.getLogger()
+        # fork の場合は親プロセスのハンドラが引き継がれているので、ログが重複しないように置き換える
+        for handler in root_logger.handlers[:]:
+            root_logger.removeHandler(handler)
+        root_logger.addHandler(QueueHandler(log_queue))
+        root_logger.setLevel(logging.INFO)
+        _worker_logging_configured = True
+    PullCommand._extract_layer_tar(tar_path, contents_path, verbose)
+
+
+def _get_positive_int_env(name: str, default: int) -> int:
+    """
+    環境変数から 1 以上の整数を取得する
+    不正な値が指定された場合は終了する
+    :param name: 環境変数名
+    :param default: 環境変数が指定されない場合の値
+    :return:
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if not value.isdigit() or int(value) < 1:
+        print(f'invalid {name}: {value!r} (must be an integer of 1 or more)')
+        sys.exit(1)
+    return int(value)
+
+
+def main(image_name: str, verbose: bool = False):
     # image 部分をパース
-    m = re.match(r'((?P<library>[^/:]*)/)?(?P<image>[^/:]+)(:)?(?P<tag>[^/:]*)', image_name)
+    m = _IMAGE_RE.match(image_name)
     if not m:
         print('invalid args')
         sys.exit(1)
@@ -163,8 +717,30 @@ def main(image_name: str):
     # tag が指定されない場合は 'latest' をセットする
     tag = m.group('tag') if m.group('tag') else 'latest'
 
-    PullCommand.execute(library, image, tag)
+    # 同時にダウンロードするレイヤーの最大数は環境変数で変更できる
+    max_concurrent_downloads = _get_positive_int_env('MAX_CONCURRENT_DOWNLOADS',
+                                                     PullCommand.DEFAULT_MAX_CONCURRENT_DOWNLOADS)
+    # 1 つのレイヤーを分割してダウンロードする数は環境変数で変更できる
+    layer_download_parts = _get_positive_int_env('LAYER_DOWNLOAD_PARTS',
+                                                 PullCommand.DEFAULT_LAYER_DOWNLOAD_PARTS)
+
+    # 展開用の子プロセスに引数として渡せるよう、マネージャーのキューを使う
+    with multiprocessing.Manager() as manager:
+        log_queue = manager.Queue()
+        listener, queue_handler = _start_logging(log_queue)
+        try:
+            PullCommand.execute(library, image, tag,
+                                max_concurrent_downloads=max_concurrent_downloads,
+                                layer_download_parts=layer_download_parts,
+                                verbose=verbose,
+                                log_queue=log_queue)
+        finally:
+            # キューに残っているログをすべて書き込んでから終了する
+            listener.stop()
+            # 続けて main を呼び出した場合にハンドラが重複しないよう、追加したハンドラを取り除く
+            logging.getLogger().removeHandler(queue_handler)
 
 
 if __name__ == '__main__':
-    main(sys.argv[1])
+    # コマンド実行時の引数: python pull.py <image_name> [--verbose]
+    main(sys.argv[1], verbose='--verbose' in sys.argv[2:])
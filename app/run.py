@@ -1,3 +1,4 @@
+import json
 import os
 import re
 import stat
@@ -8,6 +9,32 @@ from typing import List
 import linux
 from dataclasses import dataclass
 
+# イメージ名 ([library/]image[:tag]) をパースする正規表現
+_IMAGE_RE = re.compile(r'((?P<library>[^/: ]*)/)?(?P<image>[^/: ]+)(:(?P<tag>[^/: ]*))?')
+
+# コンテナの /dev に作成するシンボリックリンク (名前, リンク先)
+_DEVICE_SYMLINKS = [
+    ('stdin', '/proc/self/fd/0'),
+    ('stdout', '/proc/self/fd/1'),
+    ('stderr', '/proc/self/fd/2'),
+    ('fd', '/proc/self/fd'),
+]
+
+# コンテナの /dev に作成するデバイス (名前, モード, デバイス番号)
+# コンテナを起動するたびに計算しないよう、モードとデバイス番号はあらかじめ計算しておく
+_DEVICES = [
+    (device, 0o666 | dev_type, os.makedev(major, minor))
+    for device, (dev_type, major, minor) in {
+        'null': (stat.S_IFCHR, 1, 3),
+        'zero': (stat.S_IFCHR, 1, 5),
+        'random': (stat.S_IFCHR, 1, 8),
+        'urandom': (stat.S_IFCHR, 1, 9),
+        'console': (stat.S_IFCHR, 136, 1),
+        'tty': (stat.S_IFCHR, 5, 0),
+        'full': (stat.S_IFCHR, 1, 7)
+    }.items()
+]
+
 
 @dataclass(frozen=True)
 class Image:
@@ -68,8 +95,7 @@ class ContainerExecuter:
         container_cow_workdir = os.path.join(container_data_base_dir, 'cow_workdir')
 
         for d in (container_rootfs_dir, container_cow_rw_dir, container_cow_workdir):
-            if not os.path.exists(d):
-                os.makedirs(d)
+            os.makedirs(d, exist_ok=True)
 
         return ContainerDir(
             root_dir=container_rootfs_dir,
@@ -86,61 +112,58 @@ class ContainerExecuter:
         image_path = self._get_image_base_path(image, self.IMAGE_DATA_DIR)
         image_root = os.path.join(image_path, 'layers/contents')
 
-        # オーバーレイ FS としてマウントする
+        # レイヤーごとのディレクトリを重ねてオーバーレイ FS としてマウントする
+        # lowerdir は左から上のレイヤーの順に並べ、pull 時に作成した init ディレクトリを一番上に重ねる
+        # マウントオプションは 1 ページ (4096 バイト) までしか渡せないので、
+        # レイヤーのディレクトリに移動して相対パスで指定し、レイヤーが多いイメージでも収まるようにする
+        lower_dirs = ['init'] + [digest.split(':', 1)[-1] for digest in self._get_layer_digests(image)]
+        os.chdir(image_root)
         linux.mount(
             'overlay',
             container_dir.root_dir,
             'overlay',
             linux.MS_NODEV,
-            f"lowerdir={image_root},upperdir={container_dir.rw_dir},workdir={container_dir.work_dir}"
+            f"lowerdir={':'.join(lower_dirs)},upperdir={container_dir.rw_dir},workdir={container_dir.work_dir}"
         )
 
+    def _get_layer_digests(self, image: Image) -> List[str]:
+        """
+        pull 時に保存したマニフェストから、上のレイヤーから順に並んだレイヤーの digest を取得する
+        :param image:
+        :return:
+        """
+        with open(self._get_image_base_path(image, self.IMAGE_DATA_DIR) + '.json') as manifest_file:
+            manifest = json.load(manifest_file)
+        # https://docs.docker.com/registry/spec/manifest-v2-1/
+        # fsLayers は上のレイヤーから順に並んでいる。同じレイヤーは 1 度だけ重ねる
+        return list(dict.fromkeys(layer['blobSum'] for layer in manifest['fsLayers']))
+
     def _init_system_dir(self, container_root_dir: str):
         """
         システム用のディレクトリを初期化する
         :param container_root_dir:
         :return:
         """
-        proc_dir = os.path.join(container_root_dir, 'proc')
-        sysfs_dir = os.path.join(container_root_dir, 'sys')
         dev_dir = os.path.join(container_root_dir, 'dev')
-        for d in (proc_dir, sysfs_dir, dev_dir):
-            if not os.path.exists(d):
-                os.makedirs(d)
-
-        # コンテナのルートディレクトリ配下に /proc, /sys, /dev をマウントする
-        linux.mount('proc', proc_dir, 'proc', 0, '')
-        linux.mount('sysfs', sysfs_dir, 'sysfs', 0, '')
-        linux.mount('tmpfs', dev_dir, 'tmpfs',
-                    linux.MS_NOSUID | linux.MS_STRICTATIME, 'mode=755')
 
-        # デバイスをマウントする
-        devpts_path = os.path.join(container_root_dir, 'dev', 'pts')
-        if not os.path.exists(devpts_path):
-            os.makedirs(devpts_path)
-            linux.mount('devpts', devpts_path, 'devpts', 0, '')
+        # コンテナのルートディレクトリ配下に /proc, /sys, /dev と、デバイス用の /dev/pts をマウントする
+        # マウント先のディレクトリの作成とマウントは 1 回の呼び出しでまとめて行う
+        linux.mount_all([
+            ('proc', os.path.join(container_root_dir, 'proc'), 'proc', 0, ''),
+            ('sysfs', os.path.join(container_root_dir, 'sys'), 'sysfs', 0, ''),
+            ('tmpfs', dev_dir, 'tmpfs', linux.MS_NOSUID | linux.MS_STRICTATIME, 'mode=755'),
+            ('devpts', os.path.join(dev_dir, 'pts'), 'devpts', 0, ''),
+        ])
 
-        self._init_devices(os.path.join(container_root_dir, 'dev'))
+        self._init_devices(dev_dir)
 
     def _init_devices(self, dev_path):
-        for i, dev in enumerate(['stdin', 'stdout', 'stderr']):
-            os.symlink('/proc/self/fd/%d' % i, os.path.join(dev_path, dev))
-        os.symlink('/proc/self/fd', os.path.join(dev_path, 'fd'))
+        for name, target in _DEVICE_SYMLINKS:
+            os.symlink(target, os.path.join(dev_path, name))
 
         # その他基本的なデバイスを追加する
-        devices = {
-            'null': (stat.S_IFCHR, 1, 3),
-            'zero': (stat.S_IFCHR, 1, 5),
-            'random': (stat.S_IFCHR, 1, 8),
-            'urandom': (stat.S_IFCHR, 1, 9),
-            'console': (stat.S_IFCHR, 136, 1),
-            'tty': (stat.S_IFCHR, 5, 0),
-            'full': (stat.S_IFCHR, 1, 7)
-        }
-
-        for device, (dev_type, major, minor) in devices.items():
-            os.mknod(os.path.join(dev_path, device),
-                     0o666 | dev_type, os.makedev(major, minor))
+        for name, mode, device in _DEVICES:
+            os.mknod(os.path.join(dev_path, name), mode, device)
 
     def _get_image_base_path(self, image: Image, image_dir: str) -> str:
         return os.path.join(image_dir, f'{image.library}_{image.image}_{image.tag}')
@@ -154,14 +177,21 @@ class ContainerExecuter:
         :param container_root_dir:
         :return:
         """
+        # old_root は通常 pull 時にイメージの init ディレクトリに作成されている
         old_root = os.path.join(container_root_dir, 'old_root')
-        os.makedirs(old_root)
+        try:
+            os.mkdir(old_root)
+            created_old_root = True
+        except FileExistsError:
+            created_old_root = False
         linux.pivot_root(container_root_dir, old_root)
 
         os.chdir('/')
 
         linux.umount2('/old_root', linux.MNT_DETACH)
-        os.rmdir('/old_root')
+        # イメージのディレクトリを削除すると cow_rw にホワイトアウトが作成されるので、ここで作成した場合のみ削除する
+        if created_old_root:
+            os.rmdir('/old_root')
 
 
 class RunCommand:
@@ -179,7 +209,7 @@ class RunCommand:
 
 def main(args):
     # コマンド実行時の引数: python run.py <image_name> <command>
-    m = re.match(r'((?P<library>[^/: ]*)/)?(?P<image>[^/: ]+)(:(?P<tag>[^/: ]*))?', args[1])
+    m = _IMAGE_RE.match(args[1])
     if not m:
         print('invalid args')
         sys.exit(1)